@@ -116,8 +116,8 @@ class MultiAnsModel(object):
 
         if self.config.pos_size: #使用POS特征
             self.logger.info('we use the {} dim pos feature!'.format(self.config.pos_size))
-            self.p_pos = tf.placeholder(tf.int32, [None, None], name='p_pos') # shape=[batch*p_num,p_len]
-            self.q_pos = tf.placeholder(tf.int32, [None, None], name='q_pos') # shape=[batch*p_num,q_len]
+            self.p_pos = tf.placeholder(tf.int8, [None, None], name='p_pos') # shape=[batch*p_num,p_len]
+            self.q_pos = tf.placeholder(tf.int8, [None, None], name='q_pos') # shape=[batch*p_num,q_len]
 
         if self.config.use_pos_freq:
             self.logger.info('we use pos freq feature!')
@@ -130,8 +130,8 @@ class MultiAnsModel(object):
 
         if self.config.use_keyword_feature: #使用 keyword特征
             self.logger.info('we use the keyword feature!')
-            self.p_keyword = tf.placeholder(tf.int32, [None, None], name='p_keyword') # shape=[batch*p_num,p_len]
-            self.q_keyword = tf.placeholder(tf.int32, [None, None], name='q_keyword') # shape=[batch*p_num,q_len]
+            self.p_keyword = tf.placeholder(tf.int8, [None, None], name='p_keyword') # shape=[batch*p_num,p_len]
+            self.q_keyword = tf.placeholder(tf.int8, [None, None], name='q_keyword') # shape=[batch*p_num,q_len]
 
         if self.config.use_para_match_score_feature:
             self.logger.info('we use para match score feature!')
@@ -192,8 +192,8 @@ class MultiAnsModel(object):
                 self.q_emb = tf.concat([self.q_emb, tf.one_hot(self.q_fine, self.config.fine_cls_num, axis=2)], axis=-1)
 
             if self.config.pos_size:
-                self.p_emb = tf.concat([self.p_emb, tf.one_hot(self.p_pos, self.config.pos_size, axis=2)], axis=-1)
-                self.q_emb = tf.concat([self.q_emb, tf.one_hot(self.q_pos, self.config.pos_size, axis=2)], axis=-1)
+                self.p_emb = tf.concat([self.p_emb, tf.one_hot(tf.cast(self.p_pos, tf.int32), self.config.pos_size, axis=2)], axis=-1)
+                self.q_emb = tf.concat([self.q_emb, tf.one_hot(tf.cast(self.q_pos, tf.int32), self.config.pos_size, axis=2)], axis=-1)
 
             if self.config.use_pos_freq:
                 self.p_emb = tf.concat([self.p_emb, tf.expand_dims(self.p_freq, axis=2)], axis=-1)
@@ -203,8 +203,8 @@ class MultiAnsModel(object):
                 self.p_emb = tf.concat([self.p_emb, tf.one_hot(self.p_wiq, 2, axis=2)], axis=-1)
 
             if self.config.use_keyword_feature:
-                self.p_emb = tf.concat([self.p_emb, tf.one_hot(self.p_keyword, 2, axis=2)], axis=-1)
-                self.q_emb = tf.concat([self.q_emb, tf.one_hot(self.q_keyword, 2, axis=2)], axis=-1)
+                self.p_emb = tf.concat([self.p_emb, tf.one_hot(tf.cast(self.p_keyword, tf.int32), 2, axis=2)], axis=-1)
+                self.q_emb = tf.concat([self.q_emb, tf.one_hot(tf.cast(self.q_keyword, tf.int32), 2, axis=2)], axis=-1)
 
     def _encode(self):
         """
@@ -177,6 +177,8 @@ def parse_args():
                                help='the dir to output the results')
     path_settings.add_argument('--summary_dir', default='cache/summary/',
                                help='the dir to write tensorboard summary')
+    path_settings.add_argument('--dataset_cache_dir', default='cache/dataset/',
+                               help='the dir under which each run stores its materialized id/feature arrays of dataset')
     path_settings.add_argument('--log_path',
                                help='path of the log file. If not set, logs are printed to console')
     path_settings.add_argument('--pretrained_word_path',
@@ -273,6 +275,8 @@ def train(args):
                        badcase_sample_log_file=args.badcase_sample_log_file)
     logger.info('Converting text into ids...')
     brc_data.convert_to_ids(vocab, args.use_oov2unk)
+    logger.info('Materializing dataset...')
+    brc_data.materialize(os.path.join(args.dataset_cache_dir, args.data_type))
     logger.info('Initialize the model...')
     rc_model = MultiAnsModel(vocab, args)
     logger.info('Training the model...')
@@ -307,6 +311,8 @@ def evaluate(args):
                        badcase_sample_log_file=args.badcase_sample_log_file)
     logger.info('Converting text into ids...')
     brc_data.convert_to_ids(vocab, args.use_oov2unk)
+    logger.info('Materializing dataset...')
+    brc_data.materialize(os.path.join(args.dataset_cache_dir, args.data_type))
     logger.info('Build the model...')
     rc_model = MultiAnsModel(vocab, args)
     logger.info('restore model from {}, with prefix {}'.format(os.path.join(args.model_dir, args.data_type),
@@ -347,6 +353,8 @@ def predict(args):
                        badcase_sample_log_file=args.badcase_sample_log_file)
     logger.info('Converting text into ids...')
     brc_data.convert_to_ids(vocab, args.use_oov2unk)
+    logger.info('Materializing dataset...')
+    brc_data.materialize(os.path.join(args.dataset_cache_dir, args.data_type))
 
     logger.info('Build the model...')
     rc_model = MultiAnsModel(vocab, args)
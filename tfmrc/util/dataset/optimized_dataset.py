@@ -2,7 +2,12 @@
 This module implements data process strategies.
 """
 import io
+import os
+import mmap
+import shutil
+import tempfile
 import json
+import orjson
 import logging
 import numpy as np
 import pandas as pd
@@ -67,23 +72,28 @@ class Dataset(object):
         self.rough_cls_dict = {'DESCRIPTION': 0, 'ENTITY': 1, 'YES_NO': 2}
         self.fine_cls = FineClassify()
 
+        # materialize 之后的 SoA 缓存，None 表示直接使用样本 dict 中的字段
+        self.materialized_cache = None
+        # 各数据集每个样本的 passage 长度，用于 bucket shuffle
+        self._bucket_lens = {}
+
         if self.badcase_sample_log_file:
             self.badcase_dumper = open(badcase_sample_log_file, 'w')
 
         self.train_set, self.cleaned18_dev_set, self.dev_set, self.test_set = [], [], [], []
         if train_files:
             for train_file in train_files:
-                self.train_set += self._load_dataset(train_file, train=True)
+                self.train_set.extend(self._load_dataset(train_file, train=True))
             self.logger.info('Train set size: {} questions.'.format(len(self.train_set)))
 
         if dev_files:
             for dev_file in dev_files:
-                self.dev_set += self._load_dataset(dev_file)
+                self.dev_set.extend(self._load_dataset(dev_file))
             self.logger.info('Dev set size: {} questions.'.format(len(self.dev_set)))
 
         if test_files:
             for test_file in test_files:
-                self.test_set += self._load_dataset(test_file)
+                self.test_set.extend(self._load_dataset(test_file))
             self.logger.info('Test set size: {} questions.'.format(len(self.test_set)))
 
         if self.badcase_sample_log_file:
@@ -121,75 +131,114 @@ class Dataset(object):
         else:
             self.bin_cut_train_sets = []    # dev/test
 
+    @staticmethod
+    def _mmap_lines(data_path, scan_window=64 << 20):
+        """
+        以 mmap 方式读取文件，按 scan_window 大小的窗口用 numpy 向量化查找换行符，逐行返回 bytes，
+        每次只为一个窗口分配临时数组，峰值内存与文件大小无关
+        """
+        with io.open(data_path, 'rb') as fin:
+            if os.fstat(fin.fileno()).st_size == 0:
+                return
+            mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                prev = 0
+                for window_start in range(0, len(mm), scan_window):
+                    window_len = min(scan_window, len(mm) - window_start)
+                    # 临时的 buffer view 需在 yield 之前释放，否则 mm.close() 会因仍有导出的 buffer 而失败
+                    window = np.frombuffer(mm, dtype=np.uint8, count=window_len, offset=window_start)
+                    newline_idxs = np.flatnonzero(window == 0x0A) + window_start
+                    del window
+                    for idx in newline_idxs:
+                        yield mm[prev: idx]
+                        prev = idx + 1
+                if prev < len(mm):  # 最后一行没有换行符
+                    yield mm[prev:]
+            finally:
+                mm.close()
+
+    # 加载之后不再使用的字段，直接丢弃以节省内存
+    UNUSED_SAMPLE_FIELDS = ('fake_answers', 'fact_or_opinion', 'entity_answers')
+
     def _load_dataset(self, data_path, train=False):
         """
-        Loads the dataset
+        Loads the dataset, yield the samples one by one
         """
         if train and self.max_a_len is None:
             raise ValueError('must provide max_a_len for training set!')
 
-        badcase_sample_cnt = 0  # 错误样本的数目
-        with io.open(data_path, 'r', encoding='utf-8') as fin:
-            data_set = []
-            for lidx, line in enumerate(fin):
-                if '{' not in line:
+        badcase_samples = []  # 错误样本，整个文件读完后一次性写入
+        skipped_line_cnt = 0     # 非空但不是 json 对象的行数
+        for lidx, line in enumerate(self._mmap_lines(data_path)):
+            # jsonl 的每行通常以 '{' 开头，只检查首字节；否则再去掉 BOM 和首部空白后判断
+            if line[:1] != b'{':
+                line = line.lstrip(b' \t\r\n\x0b\x0c')
+                if line.startswith(b'\xef\xbb\xbf'):
+                    line = line[3:].lstrip(b' \t\r\n\x0b\x0c')
+                if not line:
+                    continue
+                if line[:1] != b'{':
+                    skipped_line_cnt += 1
                     continue
 
-                sample = json.loads(line.strip())
-                bad_case_sample = False
+            sample = orjson.loads(line)
+            bad_case_sample = False
 
-                if train:  # 仅对训练集进行 bad case 数据清洗
-                    assert self.badcase_sample_log_file is not None
+            if train:  # 仅对训练集进行 bad case 数据清洗
+                assert self.badcase_sample_log_file is not None
 
-                    if len(sample['segmented_question']) == 0 or len(sample['documents']) == 0:
-                        bad_case_sample = True
-                        sample['error_info'] = 'empty_question'
-                    elif len(sample['fake_answers']) == 0:
+                if len(sample['segmented_question']) == 0 or len(sample['documents']) == 0:
+                    bad_case_sample = True
+                    sample['error_info'] = 'empty_question'
+                elif len(sample['fake_answers']) == 0:
+                    bad_case_sample = True
+                    sample['error_info'] = 'empty_fake_answer'
+                else:
+                    best_match_doc_ids = []
+                    best_match_scores = []
+                    answer_labels = []
+
+                    # 策略一：统计答案的平均长度，如果超过 max_a_len，则过滤该样本
+                    ans_len = [len(ans) for ans in sample['segmented_answers']]
+                    if sum(ans_len) / len(ans_len) > self.max_a_len:
+                        continue
+
+                    for ans_idx, answer_label in enumerate(sample['answer_labels']):
+                        # 对于 multi-answer 有的fake answer 没有找到
+                        if answer_label[0] == -1 or answer_label[1] == -1:
+                            continue
+
+                        # # 策略二：对单个答案进行处理，单个长度超过 max_a_len，去掉这个outlier答案，
+                        # # 如果去掉之后 answers 为空了则去掉整个样本，如果不为空，用第二好的answer
+                        # if answer_label[1] - answer_label[0] + 1 > self.max_a_len:
+                        #     continue
+
+                        best_match_doc_ids.append(sample['best_match_doc_ids'][ans_idx])
+                        best_match_scores.append(sample['best_match_scores'][ans_idx])
+                        answer_labels.append(sample['answer_labels'][ans_idx])
+
+                    if len(best_match_doc_ids) == 0:
                         bad_case_sample = True
                         sample['error_info'] = 'empty_fake_answer'
                     else:
-                        best_match_doc_ids = []
-                        best_match_scores = []
-                        answer_labels = []
-                        fake_answers = []
-
-                        # 策略一：统计答案的平均长度，如果超过 max_a_len，则过滤该样本
-                        ans_len = [len(ans) for ans in sample['segmented_answers']]
-                        if sum(ans_len) / len(ans_len) > self.max_a_len:
-                            continue
+                        sample['best_match_doc_ids'] = best_match_doc_ids
+                        sample['best_match_scores'] = best_match_scores
+                        sample['answer_labels'] = answer_labels
 
-                        for ans_idx, answer_label in enumerate(sample['answer_labels']):
-                            # 对于 multi-answer 有的fake answer 没有找到
-                            if answer_label[0] == -1 or answer_label[1] == -1:
-                                continue
-
-                            # # 策略二：对单个答案进行处理，单个长度超过 max_a_len，去掉这个outlier答案，
-                            # # 如果去掉之后 answers 为空了则去掉整个样本，如果不为空，用第二好的answer
-                            # if answer_label[1] - answer_label[0] + 1 > self.max_a_len:
-                            #     continue
-
-                            best_match_doc_ids.append(sample['best_match_doc_ids'][ans_idx])
-                            best_match_scores.append(sample['best_match_scores'][ans_idx])
-                            answer_labels.append(sample['answer_labels'][ans_idx])
-                            fake_answers.append(sample['fake_answers'][ans_idx])
-
-                        if len(best_match_doc_ids) == 0:
-                            bad_case_sample = True
-                            sample['error_info'] = 'empty_fake_answer'
-                        else:
-                            sample['best_match_doc_ids'] = best_match_doc_ids
-                            sample['best_match_scores'] = best_match_scores
-                            sample['answer_labels'] = answer_labels
-                            sample['fake_answers'] = fake_answers
-
-                if bad_case_sample:
-                    badcase_sample_cnt += 1
-                    self.badcase_dumper.write(json.dumps(sample, ensure_ascii=False) + '\n')
-                    self.badcase_dumper.flush()
-                else:
-                    data_set.append(sample)
+            if bad_case_sample:
+                badcase_samples.append(sample)
+            else:
+                for field in self.UNUSED_SAMPLE_FIELDS:
+                    sample.pop(field, None)
+                yield sample
 
-        return data_set
+        # 每个文件的 bad case 一次性写入，不再逐条 flush
+        if badcase_samples:
+            self.badcase_dumper.writelines(json.dumps(sample, ensure_ascii=False) + '\n' for sample in badcase_samples)
+        if skipped_line_cnt > 0:
+            self.logger.warning('skipped {} non-json lines in {}'.format(skipped_line_cnt, data_path))
 
     def word_iter(self, set_name=None):
         """
@@ -197,7 +246,7 @@ class Dataset(object):
         Args:
             set_name: if it is set, then the specific set will be used
         Returns:
-            a generator
+            an iterator
         """
         if set_name == 'train' and self.train_answer_len_cut_bins > 0:  # 存在 bin
             data_set = []
@@ -212,13 +261,13 @@ class Dataset(object):
         else:
             raise NotImplementedError('No data set named as {}'.format(set_name))
 
-        if data_set is not None:
-            for sample in data_set:
-                for token in sample['segmented_question']:
-                    yield token
-                for doc in sample['documents']:
-                    for token in doc['segmented_passage']:
-                        yield token
+        if data_set is None:
+            return iter([])
+        # 逐 token 的遍历交给 itertools 在 C 层完成
+        token_lists = itertools.chain.from_iterable(
+            itertools.chain([sample['segmented_question']], (doc['segmented_passage'] for doc in sample['documents']))
+            for sample in data_set)
+        return itertools.chain.from_iterable(token_lists)
 
     def convert_to_ids(self, vocab, use_oov2unk):
         """
@@ -230,24 +279,220 @@ class Dataset(object):
         # 如果是train, 则丢弃segmented_passage字段
         if self.train_answer_len_cut_bins > 0:  # 存在 bin
             for bin_set in self.bin_cut_train_sets:
-                for sample in bin_set:
-                    sample['question_token_ids'] = vocab.convert_to_ids(sample['segmented_question'], use_oov2unk)
-                    for doc in sample['documents']:
-                        doc['passage_token_ids'] = vocab.convert_to_ids(doc['segmented_passage'], use_oov2unk)
-                        doc['segmented_passage'] = []
+                self._convert_set_to_ids(bin_set, vocab, use_oov2unk, drop_segmented_passage=True)
         elif self.train_set:
-            for sample in self.train_set:
-                sample['question_token_ids'] = vocab.convert_to_ids(sample['segmented_question'], use_oov2unk)
-                for doc in sample['documents']:
-                    doc['passage_token_ids'] = vocab.convert_to_ids(doc['segmented_passage'], use_oov2unk)
+            self._convert_set_to_ids(self.train_set, vocab, use_oov2unk)
 
         for data_set in [self.dev_set, self.test_set]:
             if data_set is None:
                 continue
-            for sample in data_set:
-                sample['question_token_ids'] = vocab.convert_to_ids(sample['segmented_question'], use_oov2unk)
-                for doc in sample['documents']:
-                    doc['passage_token_ids'] = vocab.convert_to_ids(doc['segmented_passage'], use_oov2unk)
+            self._convert_set_to_ids(data_set, vocab, use_oov2unk)
+
+    def _convert_set_to_ids(self, data_set, vocab, use_oov2unk, drop_segmented_passage=False):
+        """
+        将整个数据集的 question 和 passage 拼接成一个 token 流，只调用一次 vocab.convert_to_ids，
+        再按长度切分回各个样本，避免逐个 passage 调用的开销；各样本的 ids 为同一 int32 数组上的切片
+        """
+        flat_tokens, seq_lens = [], []
+        for sample in data_set:
+            flat_tokens.extend(sample['segmented_question'])
+            seq_lens.append(len(sample['segmented_question']))
+            for doc in sample['documents']:
+                flat_tokens.extend(doc['segmented_passage'])
+                seq_lens.append(len(doc['segmented_passage']))
+
+        flat_ids = vocab.convert_to_ids(flat_tokens, use_oov2unk)
+        del flat_tokens
+        offsets = np.zeros(len(seq_lens) + 1, dtype=np.int64)
+        np.cumsum(seq_lens, out=offsets[1:])
+
+        seq_idx = 0
+        for sample in data_set:
+            sample['question_token_ids'] = flat_ids[offsets[seq_idx]: offsets[seq_idx + 1]]
+            seq_idx += 1
+            for doc in sample['documents']:
+                doc['passage_token_ids'] = flat_ids[offsets[seq_idx]: offsets[seq_idx + 1]]
+                seq_idx += 1
+                if drop_segmented_passage:
+                    doc['segmented_passage'] = []
+
+    # materialize 时按 SoA 方式扁平存储的 question/passage 序列字段
+    # pos 类别数 < 64，keyword 为 0/1，均用 int8 存储(pad 值 -1)
+    CACHE_FIELD_DTYPES = {'question_ids': np.int32, 'pos_question': np.int8,
+                          'pos_freq_question': np.float32, 'keyword_question': np.int8,
+                          'passage_ids': np.int32, 'pos_passage': np.int8,
+                          'pos_freq_passage': np.float32, 'keyword_passage': np.int8}
+
+    def _iter_all_samples(self):
+        """ 遍历 train(含 bin)/dev/test 中的所有样本 """
+        return itertools.chain(self.train_set, *self.bin_cut_train_sets, self.dev_set, self.test_set)
+
+    def _pos_ids(self, pos_list):
+        return [self.pos_meta_dict.get(pos_str, self.pos_meta_dict['other']) for pos_str in pos_list]
+
+    def _pos_freqs(self, pos_list):
+        return [self.pos_freq_dict[pos_str] for pos_str in pos_list]
+
+    def materialize(self, cache_dir):
+        """
+        将 convert_to_ids 之后的 id 及 pos/keyword 特征按 SoA 方式写成扁平的二进制文件 + offsets，
+        再以 np.memmap 只读加载，batch 构造时直接按 offsets 切片，不再遍历样本 dict 中的 python list
+        Args:
+            cache_dir: 缓存文件的根目录，每次运行在其下新建独立的子目录，
+                       避免同时运行的多个任务互相覆盖(截断)对方正在 memmap 的文件；
+                       子目录在 memmap 打开后立即删除，已打开的映射仍然有效，进程被 kill 也不会残留缓存
+        """
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        cache_dir = tempfile.mkdtemp(prefix='materialized_', dir=cache_dir)
+
+        samples = list(self._iter_all_samples())
+        # 同一个样本可能因上采样出现多次，只序列化一次
+        unique_samples = list({id(sample): sample for sample in samples}.values())
+
+        writers = {name: open(os.path.join(cache_dir, name + '.bin'), 'wb') for name in self.CACHE_FIELD_DTYPES}
+        lengths = {name: [] for name in self.CACHE_FIELD_DTYPES}
+
+        def _write(name, seq):
+            np.asarray(seq, dtype=self.CACHE_FIELD_DTYPES[name]).tofile(writers[name])
+            lengths[name].append(len(seq))
+
+        max_ans_num = max([len(sample.get('answer_labels', [])) for sample in unique_samples] + [1])
+        best_match_doc_ids = np.zeros((len(unique_samples), max_ans_num), dtype=np.int32)
+        answer_labels = np.zeros((len(unique_samples), max_ans_num, 2), dtype=np.int32)
+        match_scores = np.zeros((len(unique_samples), max_ans_num), dtype=np.float32)
+        ans_nums = np.zeros(len(unique_samples), dtype=np.int16)
+        doc_nums = np.zeros(len(unique_samples), dtype=np.int16)
+        doc_starts = [0]
+
+        for sidx, sample in enumerate(unique_samples):
+            sample['cache_idx'] = sidx
+            sample['cache_doc_start'] = doc_starts[-1]
+            _write('question_ids', sample.pop('question_token_ids'))
+            pos_question = sample.pop('pos_question')
+            _write('pos_question', self._pos_ids(pos_question))
+            _write('pos_freq_question', self._pos_freqs(pos_question))
+            _write('keyword_question', sample.pop('keyword_question'))
+            for doc in sample['documents']:
+                _write('passage_ids', doc.pop('passage_token_ids'))
+                pos_passage = doc.pop('pos_passage')
+                _write('pos_passage', self._pos_ids(pos_passage))
+                _write('pos_freq_passage', self._pos_freqs(pos_passage))
+                _write('keyword_passage', doc.pop('keyword_passage'))
+            doc_starts.append(doc_starts[-1] + len(sample['documents']))
+            doc_nums[sidx] = len(sample['documents'])
+
+            if 'best_match_doc_ids' in sample:
+                ans_num = len(sample['best_match_doc_ids'])
+                ans_nums[sidx] = ans_num
+                best_match_doc_ids[sidx, :ans_num] = sample['best_match_doc_ids']
+                answer_labels[sidx, :ans_num] = [label[:2] for label in sample['answer_labels'][:ans_num]]
+                match_scores[sidx, :ans_num] = sample['best_match_scores']
+
+        for name, writer in writers.items():
+            writer.close()
+            offsets = np.zeros(len(lengths[name]) + 1, dtype=np.int64)
+            np.cumsum(lengths[name], out=offsets[1:])
+            offsets.tofile(os.path.join(cache_dir, name + '_offsets.bin'))
+
+        np.savez(os.path.join(cache_dir, 'meta.npz'),
+                 doc_starts=np.asarray(doc_starts, dtype=np.int64),
+                 best_match_doc_ids=best_match_doc_ids,
+                 answer_labels=answer_labels,
+                 match_scores=match_scores,
+                 ans_nums=ans_nums,
+                 doc_nums=doc_nums)
+
+        self.materialized_cache = self._load_materialized(cache_dir)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        self.logger.info('materialized {} samples into {}'.format(len(unique_samples), cache_dir))
+
+    def _load_materialized(self, cache_dir):
+        """
+        以 np.memmap 只读方式加载 materialize 写出的缓存
+        """
+        cache = {}
+        for name, dtype in self.CACHE_FIELD_DTYPES.items():
+            data_path = os.path.join(cache_dir, name + '.bin')
+            if os.path.getsize(data_path) == 0:  # np.memmap 不支持空文件
+                cache[name] = np.zeros(0, dtype=dtype)
+            else:
+                cache[name] = np.memmap(data_path, dtype=dtype, mode='r')
+            cache[name + '_offsets'] = np.fromfile(os.path.join(cache_dir, name + '_offsets.bin'), dtype=np.int64)
+        with np.load(os.path.join(cache_dir, 'meta.npz')) as meta:
+            for key in meta.files:
+                cache[key] = meta[key]
+        return cache
+
+    def _cached_len(self, name, row):
+        if row < 0:
+            return 0
+        offsets = self.materialized_cache[name + '_offsets']
+        return int(offsets[row + 1] - offsets[row])
+
+    def _gather_to_array(self, name, rows, pad_len, pad_value):
+        """
+        按行号从 materialize 的扁平缓存中 gather 并 pad/截断到 pad_len，rows 中 -1 表示空行，
+        整个 batch 一次向量化完成，没有 python 层的逐行拷贝
+        """
+        flat = self.materialized_cache[name]
+        offsets = self.materialized_cache[name + '_offsets']
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = offsets[np.maximum(rows, 0)]
+        lens = np.where(rows >= 0, offsets[np.maximum(rows, 0) + 1] - starts, 0)
+        positions = np.arange(pad_len)
+        mask = positions < lens[:, None]
+        padded = np.full((len(rows), pad_len), pad_value, dtype=flat.dtype)
+        padded[mask] = flat[(starts[:, None] + positions)[mask]]
+        return padded
+
+    def _question_features(self, sample):
+        """
+        返回 question 的 (token_ids, pos_ids, pos_freqs, keywords)
+        """
+        return (sample['question_token_ids'], self._pos_ids(sample['pos_question']),
+                self._pos_freqs(sample['pos_question']), sample['keyword_question'])
+
+    def _passage_features(self, sample, pidx):
+        """
+        返回第 pidx 篇 passage 的 (token_ids, pos_ids, pos_freqs, keywords)
+        """
+        doc = sample['documents'][pidx]
+        return (doc['passage_token_ids'], self._pos_ids(doc['pos_passage']),
+                self._pos_freqs(doc['pos_passage']), doc['keyword_passage'])
+
+    def _append_question_features(self, batch_data, sample):
+        """
+        追加 question 的 id、pos、keyword 序列，每个样本只追加一次，返回 question 长度；
+        materialize 之后只记录缓存中的行号，padding 时再整体 gather
+        """
+        if self.materialized_cache is not None:
+            batch_data.setdefault('question_rows', []).append(sample['cache_idx'])
+            return self._cached_len('question_ids', sample['cache_idx'])
+
+        question_features = self._question_features(sample)
+        for key, feature in zip(('question_token_ids', 'pos_questions', 'pos_freq_questions', 'keyword_questions'),
+                                question_features):
+            batch_data[key].append(feature)
+        return len(question_features[0])
+
+    def _append_passage_features(self, batch_data, sample, pidx):
+        """
+        追加 passage 的 id、pos、keyword 序列及长度，sample 为 None 表示补齐出来的空 passage；
+        materialize 之后只记录缓存中的行号(空 passage 为 -1)，padding 时再整体 gather
+        """
+        if self.materialized_cache is not None:
+            passage_row = sample['cache_doc_start'] + pidx if sample is not None else -1
+            batch_data.setdefault('passage_rows', []).append(passage_row)
+            passage_len = self._cached_len('passage_ids', passage_row)
+        else:
+            passage_features = self._passage_features(sample, pidx) if sample is not None else ([], [], [], [])
+            for key, feature in zip(('passage_token_ids', 'pos_passages', 'pos_freq_passages', 'keyword_passages'),
+                                    passage_features):
+                batch_data[key].append(feature)
+            passage_len = len(passage_features[0])
+
+        batch_data['passage_length'].append(min(passage_len, self.max_p_len))
 
     def get_data_length(self, set_name):
         if set_name == 'train' and self.train_answer_len_cut_bins > 0:
@@ -317,7 +562,7 @@ class Dataset(object):
                     if calc_total_batch_cnt:
                         yield batch_set
                     else:
-                        yield self._one_mini_batch(batch_set, range(len(batch_set)), pad_id, is_testing=False)
+                        yield self._one_mini_batch(batch_set, range(len(batch_set)), pad_id, is_testing=False, keep_raw_text=False)
                 else:
                     break
 
@@ -364,7 +609,7 @@ class Dataset(object):
                     if calc_total_batch_cnt:
                         yield batch_set
                     else:
-                        yield self._one_mini_batch(batch_set, range(len(batch_set)), pad_id, is_testing=False)
+                        yield self._one_mini_batch(batch_set, range(len(batch_set)), pad_id, is_testing=False, keep_raw_text=False)
                 else:
                     break
 
@@ -388,7 +633,7 @@ class Dataset(object):
                         left_processed_cnt += 1
                         yield left_batch_set
                     else:
-                        yield self._one_mini_batch(left_batch_set, range(len(left_batch_set)), pad_id, is_testing=False)
+                        yield self._one_mini_batch(left_batch_set, range(len(left_batch_set)), pad_id, is_testing=False, keep_raw_text=False)
 
             if calc_total_batch_cnt:
                 self.logger.info('left set processed batch count {}, still remain {}'.format(left_processed_cnt, len(final_left_set) - left_processed_cnt * real_batch_size))
@@ -408,27 +653,65 @@ class Dataset(object):
             data_size = len(data_set)
             indices = np.arange(data_size)
             if shuffle:
-                np.random.shuffle(indices)
+                indices = self._bucket_shuffled_indices(set_name, data_set, batch_size)
             for batch_start in np.arange(0, data_size, batch_size):
                 batch_indices = indices[batch_start: batch_start + batch_size]
-                yield self._one_mini_batch(data_set, batch_indices, pad_id, is_testing=is_testing)
+                yield self._one_mini_batch(data_set, batch_indices, pad_id, is_testing=is_testing,
+                                           keep_raw_text=set_name != 'train')
+
+    def _max_passage_len(self, sample):
+        """ 样本中参与训练的 passage 的最大长度，决定了 batch 的 pad_p_len """
+        doc_num = min(len(sample['documents']), self.max_p_num)
+        if self.materialized_cache is not None:
+            doc_start = sample['cache_doc_start']
+            passage_lens = np.diff(self.materialized_cache['passage_ids_offsets'][doc_start: doc_start + doc_num + 1])
+        else:
+            passage_lens = [len(doc['passage_token_ids']) for doc in sample['documents'][:doc_num]]
+        return min(max(passage_lens, default=0), self.max_p_len)
+
+    def _bucket_shuffled_indices(self, set_name, data_set, batch_size):
+        """
+        bucket shuffle: 按 passage 长度排序后切分成 batch 大小的 bucket，打乱 bucket 的顺序，
+        同一 batch 内的 passage 长度接近，减少 padding。
+        长度相同的样本每次调用都随机排序，因此每个 epoch 的 bucket 划分都不同。
+        不足 batch_size 的最后一个 bucket 始终放在末尾，保证调用方按 batch_size 切分时每个 batch 恰好对应一个 bucket
+        """
+        if set_name not in self._bucket_lens:
+            self._bucket_lens[set_name] = np.array([self._max_passage_len(sample) for sample in data_set], dtype=np.int32)
+        passage_lens = self._bucket_lens[set_name]
+
+        # 以随机数作为次关键字，长度相同的样本顺序随机
+        order = np.lexsort((np.random.rand(len(passage_lens)), passage_lens))
+        buckets = [order[start: start + batch_size] for start in range(0, len(data_set), batch_size)]
+        full_bucket_cnt = len(data_set) // batch_size
+        full_buckets = buckets[:full_bucket_cnt]
+        np.random.shuffle(full_buckets)
+        buckets[:full_bucket_cnt] = full_buckets
+        return np.concatenate(buckets) if buckets else np.arange(0)
 
     def _split_list_by_specific_value(self, iterable, splitters):
         return [list(g) for k, g in itertools.groupby(iterable, lambda x: x in splitters) if not k]
 
-    def _one_mini_batch(self, data, indices, pad_id, is_testing):
+    def _one_mini_batch(self, data, indices, pad_id, is_testing, keep_raw_text=True):
         """
         Get one mini batch
         Args:
             data: all data
             indices: the indices of the samples to be selected
             pad_id:
+            is_testing: test 阶段没有答案标签
+            keep_raw_text: raw_data 中是否保留解码答案所需的文本字段，训练时只需要 question_id/question_type
         Returns:
             one batch of data
         """
         batch_raw_data = []
         for i in indices:
             sample = data[i]
+            if not keep_raw_text:
+                batch_raw_data.append({'question_id': sample['question_id'],
+                                       'question_type': sample['question_type']})
+                continue
+
             cleaned_sample = {'documents': [{'segmented_passage': doc['segmented_passage']} for doc in sample['documents']],
                               'question_id': sample['question_id'],
                               'question_type': sample['question_type'],
@@ -448,6 +731,7 @@ class Dataset(object):
                       'question_length': [],
                       'question_rough_cls': [],
                       'question_fine_cls': [],
+                      'question_slot_idxs': [],     # 每个 passage 对应的样本下标，用于展开 question 特征
 
                       'passage_token_ids': [],
                       'pos_passages': [],
@@ -474,35 +758,55 @@ class Dataset(object):
 
         batch_samples = [data[i] for i in indices]
 
-        max_passage_num = max([len(sample['documents']) for sample in batch_samples])
+        if self.materialized_cache is not None:
+            # 直接在 materialize 的定长数组上求 max，不再逐样本 len()
+            cache_idxs = np.asarray([sample['cache_idx'] for sample in batch_samples])
+            max_passage_num = int(self.materialized_cache['doc_nums'][cache_idxs].max())
+        else:
+            max_passage_num = max([len(sample['documents']) for sample in batch_samples])
         max_passage_num = min(self.max_p_num, max_passage_num)
         # 增加信息,求最大答案数
-        if not is_testing:
-            max_ans_num = max([len(sample['answer_labels']) for sample in batch_samples])
-        else:
+        if is_testing:
             max_ans_num = 1
+        elif self.materialized_cache is not None:
+            max_ans_num = int(self.materialized_cache['ans_nums'][cache_idxs].max())
+        else:
+            max_ans_num = max([len(sample['answer_labels']) for sample in batch_samples])
+
+        # 先由 passage 长度求出 padded_p_len，样本循环中即可同时计算答案的起止位置，无需再遍历一遍样本
+        padded_p_len = max([self._max_passage_len(sample) for sample in batch_samples])
+        # 增加信息,修改; test 阶段直接使用全 0 的标签
+        start_ids = np.zeros((len(batch_samples), max_ans_num), dtype=np.int32)
+        end_ids = np.zeros_like(start_ids)
+        match_scores = np.zeros((len(batch_samples), max_ans_num), dtype=np.float32)
+        fill_labels_in_loop = not is_testing and self.materialized_cache is None
 
         for sidx, sample in enumerate(batch_samples):
+            if fill_labels_in_loop:     # train / dev
+                best_match_doc_ids = sample['best_match_doc_ids']
+                answer_labels = sample['answer_labels']
+                best_match_scores = sample['best_match_scores']
+                for aidx in range(min(max_ans_num, len(best_match_doc_ids))):
+                    gold_passage_offset = padded_p_len * best_match_doc_ids[aidx]
+                    start_ids[sidx, aidx] = gold_passage_offset + answer_labels[aidx][0]
+                    end_ids[sidx, aidx] = gold_passage_offset + answer_labels[aidx][1]
+                    match_scores[sidx, aidx] = best_match_scores[aidx]
+
+            # question 的特征对样本内的所有 passage 相同，每个样本只追加一次，padding 之后再按 passage 展开
+            docs = sample['documents']
+            question_len = self._append_question_features(batch_data, sample)
+            batch_data['question_rough_cls'].append([self.rough_cls_dict[sample['question_type']]] * question_len)
+            fine_cls = self.fine_cls.get_classify_label(''.join(sample['segmented_question']))[0]
+            batch_data['question_fine_cls'].append([fine_cls] * question_len)
             for pidx in range(max_passage_num):
-                if pidx < len(sample['documents']):
-                    batch_data['question_token_ids'].append(sample['question_token_ids'])
-                    batch_data['question_length'].append(len(sample['question_token_ids']))
-                    # question 分类信息
-                    batch_data['question_rough_cls'].append([self.rough_cls_dict[sample['question_type']]] * len(sample['question_token_ids']))
-                    question_str = ''.join(sample['segmented_question'])
-                    batch_data['question_fine_cls'].append([self.fine_cls.get_classify_label(question_str)[0]] * len(sample['question_token_ids']))
-
-                    passage_token_ids = sample['documents'][pidx]['passage_token_ids']
-                    batch_data['passage_token_ids'].append(passage_token_ids)
-                    batch_data['passage_length'].append(min(len(passage_token_ids), self.max_p_len))
-                    batch_data['pos_questions'].append([self.pos_meta_dict[pos_str] if pos_str in self.pos_meta_dict else self.pos_meta_dict['other'] for pos_str in sample['pos_question']])
-                    batch_data['pos_freq_questions'].append([self.pos_freq_dict[pos_str] for pos_str in sample['pos_question']])
-                    batch_data['keyword_questions'].append(sample['keyword_question'])
-                    batch_data['pos_passages'].append([self.pos_meta_dict[pos_str] if pos_str in self.pos_meta_dict else self.pos_meta_dict['other'] for pos_str in sample['documents'][pidx]['pos_passage']])
-                    batch_data['pos_freq_passages'].append([self.pos_freq_dict[pos_str] for pos_str in sample['documents'][pidx]['pos_passage']])
-                    batch_data['keyword_passages'].append(sample['documents'][pidx]['keyword_passage'])
-                    batch_data['wiq_feature'].append(sample['documents'][pidx]['passage_word_in_question'])
-                    batch_data['doc_ids'].append([pidx] * len(passage_token_ids))
+                if pidx < len(docs):
+                    doc = docs[pidx]
+                    self._append_passage_features(batch_data, sample, pidx)
+                    batch_data['question_slot_idxs'].append(sidx)
+                    batch_data['question_length'].append(question_len)
+
+                    batch_data['wiq_feature'].append(doc['passage_word_in_question'])
+                    batch_data['doc_ids'].append([pidx] * batch_data['passage_length'][-1])
 
                     # 1. paragraph 和 question 的 max_f1 * bleu
                     para_match_socre = []
@@ -516,7 +820,6 @@ class Dataset(object):
                     para_fuzzy_matching_token_sort_ratio = []
                     para_fuzzy_matching_token_set_ratio = []
 
-                    doc = sample['documents'][pidx]
                     paras = self._split_list_by_specific_value(doc['segmented_passage'], ('<splitter>',))
                     for para_i, para in enumerate(paras):
                         para_match_socre.extend([doc['paragraph_match_score'][para_i]] * len(para) + [0])
@@ -536,24 +839,15 @@ class Dataset(object):
                     batch_data['para_fuzzy_matching_token_set_ratio'].append(para_fuzzy_matching_token_set_ratio[:-1])
 
                     if not is_testing:
-                        batch_data['is_selected'].append(
-                            int(sample['documents'][pidx]['is_selected']))
+                        batch_data['is_selected'].append(int(doc['is_selected']))
                     else:
                         batch_data['is_selected'].append(0)
                 else:
-                    batch_data['question_token_ids'].append([])
+                    self._append_passage_features(batch_data, None, None)
+                    # 空 passage 对应 padding 时追加在最后的全 pad question 行
+                    batch_data['question_slot_idxs'].append(len(batch_samples))
                     batch_data['question_length'].append(0)
-                    batch_data['passage_token_ids'].append([])
-                    batch_data['passage_length'].append(0)
                     # 增加信息
-                    batch_data['question_rough_cls'].append([])
-                    batch_data['question_fine_cls'].append([])
-                    batch_data['pos_questions'].append([])
-                    batch_data['pos_freq_questions'].append([])
-                    batch_data['keyword_questions'].append([])
-                    batch_data['pos_passages'].append([])
-                    batch_data['pos_freq_passages'].append([])
-                    batch_data['keyword_passages'].append([])
                     batch_data['wiq_feature'].append([])
                     batch_data['doc_ids'].append([])
 
@@ -566,74 +860,78 @@ class Dataset(object):
                     batch_data['para_fuzzy_matching_token_set_ratio'].append([])
                     batch_data['is_selected'].append(0)
 
-        batch_data, padded_p_len, padded_q_len = self._dynamic_padding(batch_data, pad_id)
-
-        # 增加信息,修改
-        if not is_testing:      # train / dev
-            for sample in batch_samples:
-                start_ids = []
-                end_ids = []
-                scores = []
-                for aidx in range(max_ans_num):
-                    if aidx < len(sample['best_match_doc_ids']):
-                        gold_passage_offset = padded_p_len * sample['best_match_doc_ids'][aidx]
-                        start_ids.append(gold_passage_offset + sample['answer_labels'][aidx][0])
-                        end_ids.append(gold_passage_offset + sample['answer_labels'][aidx][1])
-                        scores.append(sample['best_match_scores'][aidx])
-                    else:
-                        start_ids.append(0)
-                        end_ids.append(0)
-                        scores.append(0)
-                batch_data['start_ids'].append(start_ids)
-                batch_data['end_ids'].append(end_ids)
-                batch_data['match_scores'].append(scores)
-        else:
-            # test阶段
-            batch_data['start_ids'] = [[0] * max_ans_num] * len(indices)
-            batch_data['end_ids'] = [[0] * max_ans_num] * len(indices)
-            batch_data['match_scores'] = [[0] * max_ans_num] * len(indices)
+        batch_data, padded_q_len = self._dynamic_padding(batch_data, pad_id, padded_p_len)
+
+        if not is_testing and self.materialized_cache is not None:
+            # 直接从 materialize 的定长标签数组中 gather
+            ans_mask = np.arange(max_ans_num) < self.materialized_cache['ans_nums'][cache_idxs][:, None]
+            gold_passage_offset = padded_p_len * self.materialized_cache['best_match_doc_ids'][cache_idxs, :max_ans_num]
+            answer_labels = self.materialized_cache['answer_labels'][cache_idxs, :max_ans_num]
+            start_ids[ans_mask] = (gold_passage_offset + answer_labels[:, :, 0])[ans_mask]
+            end_ids[ans_mask] = (gold_passage_offset + answer_labels[:, :, 1])[ans_mask]
+            match_scores[ans_mask] = self.materialized_cache['match_scores'][cache_idxs, :max_ans_num][ans_mask]
+
+        batch_data['start_ids'] = start_ids
+        batch_data['end_ids'] = end_ids
+        batch_data['match_scores'] = match_scores
 
         return batch_data
 
-    def _dynamic_padding(self, batch_data, pad_id):
+    @staticmethod
+    def _pad_to_array(seqs, pad_len, pad_value, dtype):
+        """
+        将变长序列 pad/截断到 pad_len，一次性分配 (batch, pad_len) 的数组后逐行拷贝
+        """
+        padded = np.full((len(seqs), pad_len), pad_value, dtype=dtype)
+        for i, seq in enumerate(seqs):
+            n = min(len(seq), pad_len)
+            padded[i, :n] = seq[:n]
+        return padded
+
+    def _dynamic_padding(self, batch_data, pad_id, pad_p_len):
         """
-        Dynamically pads the batch_data with pad_id
+        Dynamically pads the batch_data with pad_id, passages are padded to pad_p_len
         """
-        pad_p_len = min(self.max_p_len, max(batch_data['passage_length']))
         pad_q_len = min(self.max_q_len, max(batch_data['question_length']))
-        batch_data['passage_token_ids'] = [
-            (ids + [pad_id] * (pad_p_len - len(ids)))[: pad_p_len] for ids in batch_data['passage_token_ids']]
-        batch_data['question_token_ids'] = [
-            (ids + [pad_id] * (pad_q_len - len(ids)))[: pad_q_len] for ids in batch_data['question_token_ids']]
+        # question 特征每个样本只 pad 一行，另在最后追加一行全 pad 供空 passage 使用
+        if self.materialized_cache is not None:
+            question_rows = batch_data.pop('question_rows') + [-1]
+            passage_rows = batch_data.pop('passage_rows')
+            batch_data['passage_token_ids'] = self._gather_to_array('passage_ids', passage_rows, pad_p_len, pad_id)
+            batch_data['question_token_ids'] = self._gather_to_array('question_ids', question_rows, pad_q_len, pad_id)
+            batch_data['pos_questions'] = self._gather_to_array('pos_question', question_rows, pad_q_len, -1)
+            batch_data['keyword_questions'] = self._gather_to_array('keyword_question', question_rows, pad_q_len, -1)
+            batch_data['pos_freq_questions'] = self._gather_to_array('pos_freq_question', question_rows, pad_q_len, 0.0)
+            batch_data['pos_passages'] = self._gather_to_array('pos_passage', passage_rows, pad_p_len, -1)
+            batch_data['keyword_passages'] = self._gather_to_array('keyword_passage', passage_rows, pad_p_len, -1)
+            batch_data['pos_freq_passages'] = self._gather_to_array('pos_freq_passage', passage_rows, pad_p_len, 0.0)
+        else:
+            batch_data['passage_token_ids'] = self._pad_to_array(batch_data['passage_token_ids'], pad_p_len, pad_id, np.int32)
+            batch_data['question_token_ids'] = self._pad_to_array(batch_data['question_token_ids'] + [[]], pad_q_len, pad_id, np.int32)
+            batch_data['pos_questions'] = self._pad_to_array(batch_data['pos_questions'] + [[]], pad_q_len, -1, np.int8)
+            batch_data['keyword_questions'] = self._pad_to_array(batch_data['keyword_questions'] + [[]], pad_q_len, -1, np.int8)
+            batch_data['pos_freq_questions'] = self._pad_to_array(batch_data['pos_freq_questions'] + [[]], pad_q_len, 0.0, np.float32)
+            batch_data['pos_passages'] = self._pad_to_array(batch_data['pos_passages'], pad_p_len, -1, np.int8)
+            batch_data['keyword_passages'] = self._pad_to_array(batch_data['keyword_passages'], pad_p_len, -1, np.int8)
+            batch_data['pos_freq_passages'] = self._pad_to_array(batch_data['pos_freq_passages'], pad_p_len, 0.0, np.float32)
         # 增加信息
-        batch_data['pos_questions'] = [
-            (pos + [-1] * (pad_q_len - len(pos)))[: pad_q_len] for pos in batch_data['pos_questions']]
-        batch_data['keyword_questions'] = [
-            (key + [-1] * (pad_q_len - len(key)))[: pad_q_len] for key in batch_data['keyword_questions']]
-        batch_data['pos_freq_questions'] = [
-            (freq + [0.0] * (pad_q_len - len(freq)))[: pad_q_len] for freq in batch_data['pos_freq_questions']]
-        batch_data['question_rough_cls'] = [
-            (rough + [-1] * (pad_q_len - len(rough)))[: pad_q_len] for rough in batch_data['question_rough_cls']]
-        batch_data['question_fine_cls'] = [
-            (fine + [-1] * (pad_q_len - len(fine)))[: pad_q_len] for fine in batch_data['question_fine_cls']]
-
-        batch_data['pos_passages'] = [
-            (pos + [-1] * (pad_p_len - len(pos)))[: pad_p_len] for pos in batch_data['pos_passages']]
-        batch_data['keyword_passages'] = [
-            (key + [-1] * (pad_p_len - len(key)))[: pad_p_len] for key in batch_data['keyword_passages']]
-        batch_data['pos_freq_passages'] = [
-            (freq + [0.0] * (pad_p_len - len(freq)))[: pad_p_len] for freq in batch_data['pos_freq_passages']]
-
-        batch_data['wiq_feature'] = [(wiq + [-1] * (pad_p_len - len(wiq)))[: pad_p_len] for wiq in batch_data['wiq_feature']]
-        batch_data['passage_para_match_socre'] = [(wiq + [0] * (pad_p_len - len(wiq)))[: pad_p_len] for wiq in batch_data['passage_para_match_socre']]
-
-        batch_data['para_count_based_cos_distance'] = [(dist + [0] * (pad_p_len - len(dist)))[: pad_p_len] for dist in batch_data['para_count_based_cos_distance']]
-        batch_data['para_levenshtein_distance'] = [(dist + [0] * (pad_p_len - len(dist)))[: pad_p_len] for dist in batch_data['para_levenshtein_distance']]
-        batch_data['para_fuzzy_matching_ratio'] = [(dist + [0] * (pad_p_len - len(dist)))[: pad_p_len] for dist in batch_data['para_fuzzy_matching_ratio']]
-        batch_data['para_fuzzy_matching_partial_ratio'] = [(dist + [0] * (pad_p_len - len(dist)))[: pad_p_len] for dist in batch_data['para_fuzzy_matching_partial_ratio']]
-        batch_data['para_fuzzy_matching_token_sort_ratio'] = [(dist + [0] * (pad_p_len - len(dist)))[: pad_p_len] for dist in batch_data['para_fuzzy_matching_token_sort_ratio']]
-        batch_data['para_fuzzy_matching_token_set_ratio'] = [(dist + [0] * (pad_p_len - len(dist)))[: pad_p_len] for dist in batch_data['para_fuzzy_matching_token_set_ratio']]
-
-        batch_data['doc_ids'] = [(did + [-1] * (pad_p_len - len(did)))[: pad_p_len] for did in batch_data['doc_ids']]
-
-        return batch_data, pad_p_len, pad_q_len
+        batch_data['question_rough_cls'] = self._pad_to_array(batch_data['question_rough_cls'] + [[]], pad_q_len, -1, np.int32)
+        batch_data['question_fine_cls'] = self._pad_to_array(batch_data['question_fine_cls'] + [[]], pad_q_len, -1, np.int32)
+
+        # 按每个 passage 所属的样本展开 question 特征
+        question_slot_idxs = batch_data.pop('question_slot_idxs')
+        for key in ('question_token_ids', 'pos_questions', 'keyword_questions', 'pos_freq_questions',
+                    'question_rough_cls', 'question_fine_cls'):
+            batch_data[key] = batch_data[key][question_slot_idxs]
+
+        batch_data['wiq_feature'] = self._pad_to_array(batch_data['wiq_feature'], pad_p_len, -1, np.int32)
+        batch_data['passage_para_match_socre'] = self._pad_to_array(batch_data['passage_para_match_socre'], pad_p_len, 0, np.float32)
+
+        for dist_key in ['para_count_based_cos_distance', 'para_levenshtein_distance', 'para_fuzzy_matching_ratio',
+                         'para_fuzzy_matching_partial_ratio', 'para_fuzzy_matching_token_sort_ratio',
+                         'para_fuzzy_matching_token_set_ratio']:
+            batch_data[dist_key] = self._pad_to_array(batch_data[dist_key], pad_p_len, 0, np.float32)
+
+        batch_data['doc_ids'] = self._pad_to_array(batch_data['doc_ids'], pad_p_len, -1, np.int32)
+
+        return batch_data, pad_q_len
@@ -314,7 +314,9 @@ class Vocab(LoggerMixin):
             tokens: a list of token
             all_unk: 所有oov的词是否映射到 <unk>, 默认为 False
         Returns:
-            a list of ids
+            an int32 numpy array of ids
         """
-        vec = [self.get_id(token, all_unk) for token in tokens]
+        # 相同的 token 只做一次标准化和查找
+        token_ids = {token: self.get_id(token, all_unk) for token in set(tokens)}
+        vec = np.fromiter(map(token_ids.__getitem__, tokens), dtype=np.int32, count=len(tokens))
         return vec